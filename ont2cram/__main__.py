@@ -38,6 +38,7 @@ def main(args=None):
     # parser_conv.add_argument("-a","--alignment_dir", default=None, type=str, help="Input directory containing FASTQ files (default: %(default)s)")
     parser_conv.add_argument("-m","--missing_fastq", default="error", choices=["ignore","skip","error"], help="Behavior when a read id has no corresponding basecalled fastq (default: %(default)s)")
     parser_conv.add_argument("-s","--skip_signal", action="store_true", default=False, help="Skips the raw signal data (default: %(default)s)")
+    parser_conv.add_argument("-t","--processes", type=int, default=None, help="Number of worker processes (default: CPUs available to the process)")
     # parser_conv.add_argument("-e","--include_events", action="store_true", default=False, help="Include the event table data for basecalled fastq (default: %(default)s)")
     # parser_conv.add_argument("-a","--include_fastq", action="store_true", default=False, help="Include the fastq data for basecalled fastq (default: %(default)s)")
 
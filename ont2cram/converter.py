@@ -5,6 +5,13 @@ import os
 import sys
 import array
 import re
+import gc
+import itertools
+import shutil
+import tempfile
+import queue
+import threading
+import multiprocessing
 from functools import partial
 
 # Third party imports
@@ -23,6 +30,12 @@ LAST_TAG = "zZ"
 FILENAME_TAG = "X0"
 READ_NUM_TAG_SHORT = "X1"
 READ_NUM_TAG_LONG = "X2"
+READ_NUM_LONG_PATTERN = re.compile(r"(^.*\/read_)({?[0-9a-fA-F\-]+}?)(\/.+)*$")
+READ_NUM_SHORT_PATTERN = re.compile(r"(^.*\/Reads\/Read_)(\d+)(\/.+)*$")
+NO_SHARED_VALUE = object()
+OTHER_PATH, FASTQ_PATH, SIGNAL_PATH, EVENTS_PATH = range(4)
+CHUNK_CACHE_BYTES = 16*1024*1024
+CHUNK_CACHE_SLOTS = 521
 
 htslib_parray_types = {
 'i1': 'b',
@@ -66,6 +79,7 @@ def converter (
     fastq_dir=None,
     skip_signal=False,
     missing_fastq="error",
+    processes=None,
     verbose=False,
     quiet=False,
     progress=False,
@@ -93,15 +107,17 @@ def converter (
         # Check output dir
         writable_dir(os.path.dirname(output_file))
 
+        logger.info("Pre-processing Fast5 files from: '{}'".format(os.path.abspath(input_dir)))
+        processes = processes or default_processes()
+        walk_fast5 (fast5_files=fast5_files, processes=processes, progress=progress)
+
+        # Loaded only after the pre-processing pool, so that its workers do not inherit the map
         if fastq_dir:
             logger.info("Loading Fastq files from '{}'".format(os.path.abspath(fastq_dir)))
             fastq_map = read_fastq_files (fastq_files=fastq_files, progress=progress)
         else:
             fastq_map=None
 
-        logger.info("Pre-processing Fast5 files from: '{}'".format(os.path.abspath(input_dir)))
-        walk_fast5 (fast5_files=fast5_files, progress=progress)
-
         logger.info("Writing CRAM to: '{}'".format(os.path.abspath(output_file)))
         write_cram(
             fast5_base_dir=input_dir,
@@ -110,6 +126,7 @@ def converter (
             missing_fastq=missing_fastq,
             skip_signal=skip_signal,
             fastq_map=fastq_map,
+            processes=processes,
             progress=progress)
 
     finally:
@@ -134,6 +151,8 @@ def get_array_type(t):
 class Tag:
     DIGITS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
     BASE = len(DIGITS)
+    # All two character tag names, in tag number order
+    NAMES = [''.join(p) for p in itertools.product(DIGITS, repeat=2)]
     def __init__(self, start_tag="00"):
         self.current_tag_num = self.tag_to_int(start_tag)
 
@@ -144,16 +163,33 @@ class Tag:
         self.current_tag_num += 1
 
     def get_name(self):
-        return self.int_to_tag(self.current_tag_num)
-
-    def int_to_tag(self, num):
-        assert num >= 0
-        base = len(self.DIGITS)
-        res = ""
-        while not res or num > 0:
-            num, i = divmod(num, base)
-            res = self.DIGITS[i] + res
-        return res
+        return self.NAMES[self.current_tag_num]
+
+def quality_string_to_array(qual):
+    """Convert a phred+33 quality string to an array of scores in one buffer operation"""
+    if qual is None: return None
+    if type(qual) is str: qual = qual.encode('ascii')
+    return array.array( 'B', (numpy.frombuffer(qual, dtype=numpy.uint8) - 33).tobytes() )
+
+def fits_array_type(col, typecode):
+    """True if a numeric column can be cast to a flat array of typecode without changing its values"""
+    if col.ndim != 1: return False
+    target = numpy.dtype(typecode)
+    # float64 is narrowed to float32 exactly as array.array('f') would do it
+    if numpy.can_cast(col.dtype, target) or (col.dtype.kind == 'f' and target.kind == 'f'): return True
+    if col.dtype.kind not in 'iu' or target.kind not in 'iu': return False
+    limits = numpy.iinfo(target)
+    return col.size == 0 or (limits.min <= col.min() and col.max() <= limits.max)
+
+def join_string_column(col):
+    """Same as b'\\x03'.join(col.tolist()) for a fixed width bytes column, done in numpy"""
+    count, width = len(col), col.dtype.itemsize
+    buf = numpy.full( (count, width+1), 3, dtype=numpy.uint8 )
+    buf[:, :width] = numpy.ascontiguousarray(col).view(numpy.uint8).reshape(count, width)
+    # keep each value without its trailing NUL padding, followed by its separator
+    positions = numpy.arange(width+1)
+    keep = (positions < numpy.char.str_len(col)[:, None]) | (positions == width)
+    return buf[keep].tobytes()[:-1]
 
 def bytes_to_str(val):
     if type(val) in [bytes, numpy.bytes_]:
@@ -186,22 +222,20 @@ def convert_type(value):
         val = val.decode('ascii')
     return ( val, typ[:1] if typ.startswith(('U','S')) else typ )
 
-def is_fastq_path(hdf_path):
-    return hdf_path.endswith("BaseCalled_template/Fastq")
-
-def is_signal_path(hdf_path):
-    return "/Raw" in hdf_path and hdf_path.endswith("/Signal")
-
-def is_events_path(hdf_path):
-    return hdf_path.endswith("/Events")
+def classify_path(hdf_path):
+    """Tell which of the specially handled datasets, if any, an HDF5 path points to"""
+    if hdf_path.endswith("BaseCalled_template/Fastq"): return FASTQ_PATH
+    if hdf_path.endswith("/Signal") and "/Raw" in hdf_path: return SIGNAL_PATH
+    if hdf_path.endswith("/Events"): return EVENTS_PATH
+    return OTHER_PATH
 
 def types_equal(t1,t2):
     if t1.startswith('S') and t2.startswith('S'): return True
     if t1.startswith('U') and t2.startswith('U'): return True
     return t1==t2
 
-def process_dataset(hdf_path, columns):
-    if is_fastq_path(hdf_path):
+def process_dataset(dict_attributes, hdf_path, columns):
+    if classify_path(hdf_path)==FASTQ_PATH:
         return
     for column in columns:
         col_name = column[0]
@@ -209,25 +243,26 @@ def process_dataset(hdf_path, columns):
         col_type = convert_t(col_type_str)
         full_key = hdf_path+'/'+col_name
         try:
-            if not types_equal( global_dict_attributes[full_key][0], col_type ):
-                sys.exit("Column '{}' - different types in fast5 files: {} vs {}".format(full_key,global_dict_attributes[full_key][0],col_type) )
+            if not types_equal( dict_attributes[full_key][0], col_type ):
+                sys.exit("Column '{}' - different types in fast5 files: {} vs {}".format(full_key,dict_attributes[full_key][0],col_type) )
         except KeyError:
-            global_dict_attributes[full_key] = [col_type, 0]
+            dict_attributes[full_key] = [col_type, 0]
 
 def remove_read_number(attribute_path):
-    if not "/read_" in attribute_path:
-        if not "/Reads/Read_" in attribute_path:
-            return attribute_path,None,None
+    has_read_long  = "/read_" in attribute_path
+    has_read_short = "/Reads/Read_" in attribute_path
+    if not has_read_long and not has_read_short:
+        return attribute_path,None,None
 
     read_num_long = None
     read_num_short= None
 
-    match_long = re.match(r"(^.*\/read_)({?[0-9a-fA-F\-]+}?)(\/.+)*$", attribute_path)
+    match_long = has_read_long and READ_NUM_LONG_PATTERN.match(attribute_path)
     if match_long:
         attribute_path = match_long.group(1)+"XXXXX"+(match_long.group(3) or "")
         read_num_long  = match_long.group(2)
 
-    match_short = re.match(r"(^.*\/Reads\/Read_)(\d+)(\/.+)*$", attribute_path)
+    match_short = has_read_short and READ_NUM_SHORT_PATTERN.match(attribute_path)
     if match_short:
         attribute_path = match_short.group(1)+"YYY"+ (match_short.group(3) or "")
         read_num_short  = match_short.group(2)
@@ -235,49 +270,118 @@ def remove_read_number(attribute_path):
     return attribute_path,read_num_long,read_num_short
 
 def is_empty_hdf_group(hdf_node):
-    return len(hdf_node.keys())==0 and len(hdf_node.attrs.items())==0
+    return len(hdf_node)==0 and len(hdf_node.attrs)==0
 
 def construct_dummy_attr(hdf_path):
     return hdf_path+'/dummy_attr'
 
-def pre_process_group_attrs(_, hdf_node):
-    global global_dict_attributes
-
+def pre_process_group_attrs(dict_attributes, _, hdf_node):
     node_path     = hdf_node.name
     node_path,_,_ = remove_read_number( node_path )
 
     if type(hdf_node) is h5py.Dataset:
         columns = hdf_node.dtype.fields.items() if hdf_node.dtype.fields else [('noname', hdf_node.dtype.str)]
-        process_dataset( node_path, columns )
+        process_dataset( dict_attributes, node_path, columns )
     else:
         if is_empty_hdf_group(hdf_node):
-            global_dict_attributes[construct_dummy_attr(node_path)] = ['',1]
+            dict_attributes[construct_dummy_attr(node_path)] = ['',1]
 
     for key, val in hdf_node.attrs.items():
         full_key = node_path+'/'+key
         try:
-            pair = global_dict_attributes[full_key]
+            pair = dict_attributes[full_key]
             if pair[0] == val: pair[1] += 1
-            global_dict_attributes[full_key] = pair
+            dict_attributes[full_key] = pair
         except KeyError:
-            global_dict_attributes[full_key] = [ val, 1 ]
+            dict_attributes[full_key] = [ val, 1 ]
+
+def open_fast5(filename, prefetch=False):
+    """Open a fast5 file read-only, with a chunk cache large enough for a whole Signal dataset"""
+    if prefetch and hasattr(os, "posix_fadvise"):
+        # Start kernel readahead of the whole file; the page cache outlives this descriptor
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    return h5py.File(filename, 'r', rdcc_nbytes=CHUNK_CACHE_BYTES, rdcc_nslots=CHUNK_CACHE_SLOTS)
+
+def default_processes():
+    """Number of CPUs this process may run on, honouring its affinity mask where available"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
-def walk_fast5(fast5_files, progress=False):
-    for fn in tqdm.tqdm(fast5_files, unit=" files", unit_scale=True, disable=not progress):
-        with h5py.File(fn,'r') as f:
-            pre_process_group_attrs("/", f)
-            f.visititems( pre_process_group_attrs )
+def get_mp_context():
+    """Multiprocessing context, forking where possible so workers inherit the parent state"""
+    return multiprocessing.get_context("fork" if sys.platform.startswith("linux") else None)
+
+def get_pool(processes, **kwargs):
+    """Process pool of get_mp_context() workers"""
+    # Objects frozen before the fork are never traversed by the workers' garbage collector,
+    # so large inherited structures (e.g. the fastq map) stay shared instead of being copied
+    gc.freeze()
+    try:
+        return get_mp_context().Pool(processes, **kwargs)
+    finally:
+        gc.unfreeze()
+
+def scan_fast5(filename):
+    """Collect attributes and columns of a single fast5 file into a local dict"""
+    dict_attributes = {}
+    try:
+        with open_fast5(filename) as f:
+            pre_process_group_attrs(dict_attributes, "/", f)
+            f.visititems( partial(pre_process_group_attrs, dict_attributes) )
+    except SystemExit as e:
+        # A worker exiting would leave the pool waiting forever for its result
+        raise ont2cramError(e.code)
+    return dict_attributes
+
+def merge_attributes(dict_attributes):
+    """Merge the attributes of one fast5 file into the global dict"""
+    for full_key, pair in dict_attributes.items():
+        try:
+            global_pair = global_dict_attributes[full_key]
+        except KeyError:
+            global_dict_attributes[full_key] = pair
+            continue
+        if pair[1]==0:
+            if not types_equal( global_pair[0], pair[0] ):
+                sys.exit("Column '{}' - different types in fast5 files: {} vs {}".format(full_key,global_pair[0],pair[0]) )
+        elif global_pair[0] == pair[0]:
+            global_pair[1] += pair[1]
+
+def walk_fast5(fast5_files, processes, progress=False):
+    processes = min(processes, len(fast5_files))
+    with get_pool(processes) as pool:
+        # imap (not imap_unordered) keeps the merge order, hence the tag assignment, deterministic
+        results = pool.imap(scan_fast5, fast5_files, chunksize=8)
+        for dict_attributes in tqdm.tqdm(results, total=len(fast5_files), unit=" files", unit_scale=True, disable=not progress):
+            merge_attributes(dict_attributes)
 
 def is_shared_value(value, total_fast5_files):
     return value > total_fast5_files//2
 
+def matches_shared_value(value, shared_value):
+    """Compare an attribute with the value stored in the header, NaN matching NaN"""
+    if shared_value is NO_SHARED_VALUE: return False
+    if type(value) is numpy.ndarray or type(shared_value) is numpy.ndarray:
+        value, shared_value = numpy.asarray(value), numpy.asarray(shared_value)
+        # equal_nan is only supported for float arrays (isnan fails on strings)
+        equal_nan = value.dtype.kind == 'f' and shared_value.dtype.kind == 'f'
+        return numpy.array_equal(value, shared_value, equal_nan=equal_nan)
+    return value == shared_value or (value != value and shared_value != shared_value)
+
 def list_files(dir, condition):
     return [os.path.join(r,file) for r,d,f in os.walk(dir) for file in f if condition(file)]
 
-def write_cram(fast5_base_dir, fast5_files, cram_file, missing_fastq, skip_signal, fastq_map, progress=False):
+def write_cram(fast5_base_dir, fast5_files, cram_file, missing_fastq, skip_signal, fastq_map, processes, progress=False):
     """"""
     total_fast5_files = len(fast5_files)
     comments_list = []
+    tag_lookup = {}
     tag = Tag(FIRST_TAG)
     for key,val in global_dict_attributes.items():
 
@@ -285,86 +389,202 @@ def write_cram(fast5_base_dir, fast5_files, cram_file, missing_fastq, skip_signa
 
         value,hdf_type = (None,val[0]) if is_column else convert_type(val[0])
 
-        tag_and_val = "TG:"+tag.get_name()
+        tag_name = tag.get_name()
         tag.increment()
-        if tag_and_val.endswith(LAST_TAG): sys.exit("Running out of Tag space : too many atributes in Fast5")
+        if tag_name == LAST_TAG: sys.exit("Running out of Tag space : too many atributes in Fast5")
 
+        tag_and_val = "TG:"+tag_name
+        val_CV = NO_SHARED_VALUE
         if not is_column:
             if is_shared_value(val[1], total_fast5_files) and "read_number" not in key:
+                val_CV = value
                 tag_and_val += " CV:"+repr(value)
 
         comments_list.append( "{}:'{}':{} {}".format( "COL" if is_column else "ATR", key, hdf_type, tag_and_val) )
-        global_dict_attributes[key][1] = tag_and_val
+        # bytes tag names are passed to pysam without re-encoding on every set_tag
+        tag_lookup[key] = (tag_name.encode('ascii'), val_CV, hdf_type)
 
     header = {'HD': {'VN':'1.0'}, 'CO':comments_list}
-    with pysam.AlignmentFile( cram_file, "wc", header=header, format_options=[b"no_ref=1"] ) as outf:
-        for filename in tqdm.tqdm(fast5_files, unit=" files", unit_scale=True, disable=not progress):
-            with h5py.File(filename,'r') as fast5:
-
-                def get_tag_name_cv_type( hdf_full_path ):
-                    pair = global_dict_attributes[hdf_full_path]
-                    assert( pair[1].startswith("TG:") )
-                    tag_name = pair[1][3:5]
-                    pos_CV = pair[1].find("CV:")
-                    val_CV = None if pos_CV==-1 else pair[1][pos_CV+3:]
-                    return ( tag_name, val_CV, pair[0] )
-
-                def get_column( dset, col_name ):
-                    if col_name=="noname": return dset[()]
-                    return dset[col_name]
-
-                def process_dataset( cram_seg, hdf_path, dset, columns ):
-                    if is_signal_path(hdf_path) and skip_signal: return
-                    if is_events_path(hdf_path) and skip_signal: return
-                    if is_fastq_path(hdf_path)                : return
-
-                    for column in columns:
-                        col_name             = column[0]
-                        tag_name,_,hdf_type  = get_tag_name_cv_type(hdf_path+'/'+col_name)
-
-                        col = get_column(dset,col_name)
-
-                        col_values = col.tolist() if type(col) is numpy.ndarray else col
-                        tag_val = col_values
-                        if type(col_values[0]) is bytes:
-                            tag_val = b'\x03'.join(col_values)
-
-                        if type(tag_val) is numpy.bytes_: tag_val=bytes(tag_val)
-                        if type(tag_val) is list: tag_val = array.array( get_array_type(hdf_type), tag_val )
-                        cram_seg.set_tag(tag_name, tag_val)
-
-                def process_attrs( cram_seg, _, group_or_dset ):
-                    name = group_or_dset.name
-
-                    nonlocal fastq_path
-                    if is_fastq_path(name): fastq_path=name
-
-                    name,read_num_long,read_num_short  = remove_read_number( name )
-
-                    if read_num_long : cram_seg.set_tag( READ_NUM_TAG_LONG, read_num_long )
-                    if read_num_short: cram_seg.set_tag( READ_NUM_TAG_SHORT, read_num_short )
-
-                    if type(group_or_dset) is h5py.Dataset:
-                        columns = group_or_dset.dtype.fields.items() if group_or_dset.dtype.fields else [('noname', None)]
-                        process_dataset( cram_seg, name, group_or_dset, columns )
-                    else:
-                        if is_empty_hdf_group(group_or_dset):
-                            tag_name,_,_ = get_tag_name_cv_type( construct_dummy_attr(name) )
-                            cram_seg.set_tag(tag_name,1)
-
-                    for key, val in group_or_dset.attrs.items():
-                        value,hdf_type    = convert_type(val)
-                        tag_name,val_CV,_ = get_tag_name_cv_type(name+'/'+key)
-
-                        nonlocal read_id
-                        if key=="read_id":
-                            read_id = val
-
-                        try:
-                            if repr(value)!=val_CV : cram_seg.set_tag( tag_name, value, get_tag_type(hdf_type) )
-                        except ValueError:
-                            sys.exit("Could not detemine tag type (val={}, hdf_type={})".format(value,hdf_type))
 
+    processes = min(processes, total_fast5_files)
+    shards = [shard.tolist() for shard in numpy.array_split(fast5_files, processes)]
+    settings = dict(
+        header=header,
+        tag_lookup=tag_lookup,
+        fast5_base_dir=fast5_base_dir,
+        missing_fastq=missing_fastq,
+        skip_signal=skip_signal,
+        fastq_map=fastq_map,
+        files_done=get_mp_context().Queue())
+
+    if len(shards)==1:
+        tmp_dir, tmp_files = None, [cram_file]
+    else:
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(cram_file)))
+        tmp_files = [os.path.join(tmp_dir, "shard_{}.cram".format(i)) for i in range(len(shards))]
+
+    try:
+        with get_pool(processes, initializer=init_worker, initargs=(settings,)) as pool:
+            results = pool.map_async(convert_shard, list(zip(tmp_files, shards)), chunksize=1)
+            with tqdm.tqdm(total=total_fast5_files, unit=" files", unit_scale=True, disable=not progress) as pbar:
+                # Workers report every converted file, shards only complete at the end
+                while not results.ready():
+                    try:
+                        pbar.update(settings["files_done"].get(timeout=0.1))
+                    except queue.Empty:
+                        pass
+                for counter in results.get():
+                    COUNTER.update(counter)
+                pbar.update(total_fast5_files-pbar.n)
+        if tmp_dir:
+            # samtools cat copies the CRAM containers as they are, without re-encoding
+            pysam.cat("--no-PG", "-o", cram_file, *tmp_files)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+worker_settings = {}
+
+def init_worker(settings):
+    """Pool initializer: share the tag table and conversion settings with a worker"""
+    worker_settings.update(settings)
+
+def convert_shard(shard):
+    """Write a slice of the fast5 files to its own CRAM file, return the counters"""
+    cram_file, fast5_files = shard
+    COUNTER.clear()
+    try:
+        write_shard(cram_file=cram_file, fast5_files=fast5_files, **worker_settings)
+    except SystemExit as e:
+        raise ont2cramError(e.code)
+    return Counter(COUNTER)
+
+def write_records(cram_file, header, records, free_records, errors):
+    """Writer thread: encode queued records into the CRAM file until the None sentinel"""
+    try:
+        with pysam.AlignmentFile( cram_file, "wc", header=header, format_options=[b"no_ref=1"] ) as outf:
+            for a_s in iter(records.get, None):
+                outf.write(a_s)
+                free_records.put(a_s)
+    except Exception as e:
+        errors.append(e)
+        # Keep draining so that the reader never blocks on a full queue
+        for _ in iter(records.get, None): pass
+
+class RecordContext:
+    """State shared by the helpers filling the CRAM record of one read"""
+    def __init__(self, tag_lookup, skip_signal):
+        self.tag_lookup = tag_lookup
+        self.skip_signal = skip_signal
+        # Numeric datasets are read into buffers reused across reads, one per dtype
+        self.column_buffers = {}
+        self.cram_seg = None
+        self.read_id = None
+        self.fastq_dset = None
+
+    def start_record(self, cram_seg):
+        self.cram_seg = cram_seg
+        self.read_id = None
+        self.fastq_dset = None
+
+def get_column(ctx, dset, col_name):
+    if col_name!="noname": return dset[col_name]
+    if dset.ndim==0 and dset.dtype.kind=='S':
+        # Fixed length string (e.g. a Log): straight to bytes, without an intermediate numpy.bytes_
+        buf = numpy.empty((), dtype=dset.dtype)
+        dset.id.read(h5py.h5s.ALL, h5py.h5s.ALL, buf)
+        return buf.tobytes().rstrip(b'\x00')
+    if dset.ndim!=1 or dset.size==0 or dset.dtype.kind not in 'iuf': return dset[()]
+
+    size = dset.shape[0]
+    buf = ctx.column_buffers.get(dset.dtype)
+    if buf is None or buf.size < size:
+        buf = ctx.column_buffers[dset.dtype] = numpy.empty(size, dtype=dset.dtype)
+    # The low level read skips h5py's selection handling, the whole dataset goes to the buffer
+    dset.id.read(h5py.h5s.ALL, h5py.h5s.ALL, buf[:size])
+    return buf[:size]
+
+def process_dataset_columns(ctx, hdf_path, dset, columns):
+    cram_seg = ctx.cram_seg
+    for column in columns:
+        col_name             = column[0]
+        tag_name,_,hdf_type  = ctx.tag_lookup[hdf_path+'/'+col_name]
+
+        col = get_column(ctx,dset,col_name)
+
+        typecode = get_array_type(hdf_type) if type(col) is numpy.ndarray and col.dtype.kind in 'iuf' else None
+        if typecode and fits_array_type(col, typecode):
+            # Cast and copy the whole column at once instead of element by element
+            cram_seg.set_tag(tag_name, array.array( typecode, col.astype(typecode, copy=False).tobytes() ))
+            continue
+
+        if type(col) is numpy.ndarray and col.dtype.kind == 'S':
+            cram_seg.set_tag(tag_name, join_string_column(col))
+            continue
+
+        col_values = col.tolist() if type(col) is numpy.ndarray else col
+        tag_val = col_values
+        if type(col_values[0]) is bytes:
+            tag_val = b'\x03'.join(col_values)
+
+        if type(tag_val) is list: tag_val = array.array( get_array_type(hdf_type), tag_val )
+        cram_seg.set_tag(tag_name, tag_val)
+
+def process_attrs(ctx, _, group_or_dset):
+    cram_seg = ctx.cram_seg
+    name = group_or_dset.name
+    path_kind = classify_path(name)
+
+    if path_kind==FASTQ_PATH: ctx.fastq_dset=group_or_dset
+
+    name,read_num_long,read_num_short  = remove_read_number( name )
+
+    if read_num_long : cram_seg.set_tag( READ_NUM_TAG_LONG, read_num_long )
+    if read_num_short: cram_seg.set_tag( READ_NUM_TAG_SHORT, read_num_short )
+
+    if type(group_or_dset) is h5py.Dataset:
+        # Skipped datasets still carry attributes, only their type and data are left alone
+        if path_kind!=FASTQ_PATH and not (ctx.skip_signal and path_kind in (SIGNAL_PATH, EVENTS_PATH)):
+            columns = group_or_dset.dtype.fields.items() if group_or_dset.dtype.fields else [('noname', None)]
+            process_dataset_columns( ctx, name, group_or_dset, columns )
+    else:
+        if is_empty_hdf_group(group_or_dset):
+            tag_name,_,_ = ctx.tag_lookup[construct_dummy_attr(name)]
+            cram_seg.set_tag(tag_name,1)
+
+    set_attr_tags(ctx, name, group_or_dset.attrs)
+
+def set_attr_tags(ctx, name, attrs):
+    """Tag the attributes of a node that differ from their shared value, with lookups bound outside the loop"""
+    set_tag    = ctx.cram_seg.set_tag
+    tag_lookup = ctx.tag_lookup
+    prefix     = name+'/'
+    for key, val in attrs.items():
+        value,hdf_type    = convert_type(val)
+        tag_name,val_CV,_ = tag_lookup[prefix+key]
+
+        if key=="read_id":
+            ctx.read_id = val
+
+        try:
+            if not matches_shared_value(value, val_CV) : set_tag( tag_name, value, get_tag_type(hdf_type) )
+        except ValueError:
+            sys.exit("Could not detemine tag type (val={}, hdf_type={})".format(value,hdf_type))
+
+def write_shard(cram_file, header, tag_lookup, fast5_files, fast5_base_dir, missing_fastq, skip_signal, fastq_map, files_done):
+    # pysam releases the GIL while encoding, so reading fast5 files overlaps with CRAM compression
+    records = queue.Queue(maxsize=64)
+    # Written records come back to be reused, instead of allocating one per read
+    free_records = queue.Queue()
+    errors = []
+    writer = threading.Thread(target=write_records, args=(cram_file, header, records, free_records, errors))
+    writer.start()
+    ctx = RecordContext(tag_lookup, skip_signal)
+    try:
+        for filename in fast5_files:
+            # The pre-processing pass only reads metadata, the whole file is only worth prefetching here
+            with open_fast5(filename, prefetch=not skip_signal) as fast5:
+                fast5_relpath = os.path.relpath(filename,fast5_base_dir)
                 read_groups = [fast5]
                 if next(iter(fast5)).startswith("read_"):
                     read_groups = [ fast5[k] for k in fast5.keys()]
@@ -372,21 +592,24 @@ def write_cram(fast5_base_dir, fast5_files, cram_file, missing_fastq, skip_signa
                 for read_group in read_groups:
                     COUNTER["reads found in fast5"] += 1
 
-                    a_s = pysam.AlignedSegment()
-                    a_s.set_tag( FILENAME_TAG, os.path.relpath(filename,fast5_base_dir) )
-
-                    read_id = None
-                    fastq_path = None
+                    try:
+                        a_s = free_records.get_nowait()
+                        a_s.set_tags([])
+                    except queue.Empty:
+                        a_s = pysam.AlignedSegment()
+                    a_s.set_tag( FILENAME_TAG, fast5_relpath )
 
-                    process_attrs(a_s, None, read_group) #root group
-                    read_group.visititems( partial(process_attrs,a_s) )
+                    ctx.start_record(a_s)
+                    process_attrs(ctx, None, read_group) #root group
+                    read_group.visititems( partial(process_attrs, ctx) )
+                    read_id = ctx.read_id
 
                     read_name = "nofastq"
                     read_seq = None
                     read_qual = None
 
-                    if fastq_path:
-                        read_name, read_seq, sep ,read_qual = read_group[fastq_path].value.splitlines()
+                    if ctx.fastq_dset is not None:
+                        read_name, read_seq, sep ,read_qual = ctx.fastq_dset[()].splitlines()
 
                     if fastq_map:
                         if not read_id:
@@ -406,7 +629,7 @@ def write_cram(fast5_base_dir, fast5_files, cram_file, missing_fastq, skip_signa
 
                     a_s.query_name = read_name
                     a_s.query_sequence=read_seq
-                    a_s.query_qualities = pysam.qualitystring_to_array(read_qual)
+                    a_s.query_qualities = quality_string_to_array(read_qual)
                     a_s.flag = 4
                     a_s.reference_id = -1
                     a_s.reference_start = 0
@@ -418,4 +641,10 @@ def write_cram(fast5_base_dir, fast5_files, cram_file, missing_fastq, skip_signa
                     a_s.is_unmapped = True
 
                     COUNTER["reads written in CRAM"]+=1
-                    outf.write(a_s)
+                    records.put(a_s)
+            files_done.put(1)
+    finally:
+        records.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
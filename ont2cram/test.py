@@ -10,6 +10,10 @@ import tempfile
 import unittest
 import subprocess
 import argparse
+import array
+import h5py
+import numpy
+import pysam
 from parameterized import parameterized
 
 
@@ -24,11 +28,16 @@ IGNORE_LINES  = [
 
 
 TEST_DATA_DIR = os.path.join( os.path.dirname(os.path.abspath(__file__)), "test_data" )
+MULTI_FILE_DIR = os.path.join( TEST_DATA_DIR, "single-read-10-files-ena" )
 print(f"test data dir = {TEST_DATA_DIR}")
 
 def get_all_fast5_files(dir):
 	return  [f for f in os.listdir(dir) if os.path.isfile(os.path.join(dir, f)) and f.endswith(".fast5")]	
 
+def read_cram_records(cram_path):
+    with pysam.AlignmentFile(cram_path, "rc", check_sq=False) as f:
+        return f.header.to_dict(), [r.to_dict() for r in f.fetch(until_eof=True)]
+
 def h5dump_all_files_in_dir(input_dir, output_dir):
     files = get_all_fast5_files(input_dir)
     for f in files:
@@ -99,6 +108,13 @@ class Ont2CramTests(unittest.TestCase):
 
     @parameterized.expand([x[0] for x in os.walk(TEST_DATA_DIR)])
     def test_round_trip(self, fast5_dir):
+        self.round_trip(fast5_dir)
+
+    def test_round_trip_sharded(self):
+        # More processes than one forces per-process CRAMs joined with samtools cat
+        self.round_trip(MULTI_FILE_DIR, processes=3)
+
+    def round_trip(self, fast5_dir, **kwargs):
         self.fast5_origial_dir = fast5_dir
         files = get_all_fast5_files(self.fast5_origial_dir)
         print("Testing dir={}, total files={}".format(self.fast5_origial_dir, len(files)))        
@@ -108,7 +124,7 @@ class Ont2CramTests(unittest.TestCase):
         try:
 
             #forward conversion
-            converter.converter( input_dir=self.fast5_origial_dir, fastq_dir=None, output_file=cram_path, skip_signal=False ) 
+            converter.converter( input_dir=self.fast5_origial_dir, fastq_dir=None, output_file=cram_path, skip_signal=False, **kwargs ) 
             
             #reverse conversion
             reverse_converter.reverse_converter( input_file=cram_path, output_dir=self.fast5_restored_dir )
@@ -124,6 +140,75 @@ class Ont2CramTests(unittest.TestCase):
         	else:
         		os.remove(cram_path)
 
+class ConverterTests(unittest.TestCase):
+
+    def test_sharded_conversion_matches_single_process(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            records = []
+            for processes in (1, 3):
+                cram_path = os.path.join(tmp_dir, "out_{}.cram".format(processes))
+                converter.converter( input_dir=MULTI_FILE_DIR, output_file=cram_path, processes=processes, quiet=True )
+                records.append( read_cram_records(cram_path) )
+            self.assertEqual(len(records[0][1]), len(get_all_fast5_files(MULTI_FILE_DIR)))
+            self.assertEqual(records[0], records[1])
+            # the temporary per-process CRAMs are removed
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["out_1.cram", "out_3.cram"])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def dataset_tag(self, data, hdf_type):
+        """Convert an in-memory dataset with the converter's column code, return its tag value"""
+        with h5py.File("in_memory.fast5", "w", driver="core", backing_store=False) as f:
+            dset = f.create_dataset("d", data=data)
+            ctx = converter.RecordContext({"/d/noname": (b"a0", converter.NO_SHARED_VALUE, hdf_type)}, skip_signal=False)
+            ctx.start_record(pysam.AlignedSegment())
+            converter.process_dataset_columns(ctx, "/d", dset, [("noname", None)])
+            return ctx.cram_seg.get_tag("a0")
+
+    def test_numeric_column(self):
+        self.assertEqual(self.dataset_tag(numpy.array([1, -2, 3], dtype="i2"), "i2"), array.array("h", [1, -2, 3]))
+        self.assertEqual(self.dataset_tag(numpy.array([1, 2**31-1], dtype="i8"), "i8"), array.array("i", [1, 2**31-1]))
+
+    def test_numeric_column_out_of_range(self):
+        # int64 is stored as int32: values that do not fit must fail, not wrap around
+        with self.assertRaises(OverflowError):
+            self.dataset_tag(numpy.array([1, 2**33+5], dtype="i8"), "i8")
+
+    def test_numeric_column_2d(self):
+        # a flat tag could not restore the shape
+        with self.assertRaises(TypeError):
+            self.dataset_tag(numpy.array([[1, 2], [3, 4]], dtype="i2"), "i2")
+
+    def test_join_string_column(self):
+        col = numpy.array([b"a\x00b", b"", b"abcd", b"\x00x"], dtype="S4")
+        # trailing NUL padding is dropped, embedded NULs are kept
+        self.assertEqual(converter.join_string_column(col), b"a\x00b\x03\x03abcd\x03\x00x")
+        self.assertEqual(converter.join_string_column(numpy.array([b"", b""], dtype="S2")), b"\x03")
+        self.assertEqual(converter.join_string_column(numpy.array([], dtype="S3")), b"")
+
+    def test_join_string_column_non_contiguous(self):
+        col = numpy.array([b"a\x00b", b"", b"abcd", b"\x00x"], dtype="S4")
+        self.assertEqual(converter.join_string_column(col[::2]), b"a\x00b\x03abcd")
+        table = numpy.array([(1, b"ab"), (2, b"c")], dtype=[("n", "i4"), ("s", "S3")])
+        self.assertEqual(converter.join_string_column(table["s"]), b"ab\x03c")
+
+    def test_quality_string_to_array(self):
+        self.assertIsNone(converter.quality_string_to_array(None))
+        self.assertEqual(converter.quality_string_to_array("!+5I"), array.array("B", [0, 10, 20, 40]))
+        self.assertEqual(converter.quality_string_to_array(b"!+5I"), array.array("B", [0, 10, 20, 40]))
+        self.assertEqual(converter.quality_string_to_array(""), array.array("B"))
+
+    def test_matches_shared_value(self):
+        nan = float("nan")
+        self.assertTrue(converter.matches_shared_value(nan, nan))
+        self.assertTrue(converter.matches_shared_value(numpy.float32(nan), nan))
+        self.assertFalse(converter.matches_shared_value(1.0, nan))
+        self.assertTrue(converter.matches_shared_value(numpy.array([1.0, nan]), numpy.array([1.0, nan])))
+        self.assertFalse(converter.matches_shared_value(numpy.array([1.0, nan]), numpy.array([2.0, nan])))
+        self.assertTrue(converter.matches_shared_value(numpy.array([b"a", b"b"]), numpy.array([b"a", b"b"])))
+        self.assertFalse(converter.matches_shared_value(nan, converter.NO_SHARED_VALUE))
+
 def test(keep_tmp=False, **kwargs):
 	global KEEP_TMP
 	KEEP_TMP = keep_tmp	
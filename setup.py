@@ -15,8 +15,8 @@ setup(
         'h5py>=2.10',
         "ont_fast5_api>=2.0.0",
         "tqdm>=4.39.0",
-        "pysam>=0.15.3",
-        "numpy>=1.17.4 ",
+        "pysam>=0.16",
+        "numpy>=1.19 ",
         "parameterized>=0.7.1"],
     keywords=pkg.__keywords__,
     license=pkg.__license__,